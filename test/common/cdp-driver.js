@@ -225,6 +225,7 @@ function setupSSLCertHandling(client) {
  * Read one line with a JS expression, eval() it, and respond with the result:
  *    success <JSON formatted return value>
  *    fail <JSON formatted error>
+ * Several commands can be in flight; their responses are sent in command order.
  * EOF shuts down the client.
  */
 process.stdin.setEncoding('utf8');
@@ -251,6 +252,9 @@ CDP.New(options)
                 setupSSLCertHandling(client);
 
                 let input_buf = '';
+                // commands run concurrently, but their replies go out in the order of the
+                // commands, so that the client can send several commands without waiting
+                let reply = Promise.resolve();
                 process.stdin
                     .on('data', chunk => {
                         input_buf += chunk;
@@ -260,9 +264,10 @@ CDP.New(options)
                                 break;
 
                             // run the command
-                            eval(input_buf.slice(0, i))
-                                .then(success)
-                                .catch(fail);
+                            let done = eval(input_buf.slice(0, i))
+                                .then(result => () => success(result),
+                                      err => () => fail(err));
+                            reply = reply.then(() => done).then(respond => respond()).catch(fail);
 
                             input_buf = input_buf.slice(i+1);
                         }
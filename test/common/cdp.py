@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import contextlib
+import distutils.spawn
 import fcntl
-import glob
 import json
 import os
 import random
+import re
 import shutil
 import socket
 import subprocess
@@ -15,6 +18,8 @@ import time
 TEST_DIR = os.path.normpath(os.path.dirname(os.path.realpath(os.path.join(__file__, ".."))))
 
 
+_browser_paths = { }
+
 def browser_path(headless=True):
     """Return path to CDP browser.
 
@@ -24,26 +29,105 @@ def browser_path(headless=True):
        headless is true
      - node_modules/chromium/lib/chromium/chrome-linux/chrome (npm install chromium)
 
-    Exit with an error if none is found.
+    Exit with an error if none is found. The result is cached.
     """
+    headless = bool(headless)
+    if headless not in _browser_paths:
+        _browser_paths[headless] = _find_browser(headless)
+    return _browser_paths[headless]
+
+
+def _find_browser(headless):
+    p = distutils.spawn.find_executable("chromium-browser")
+    if p:
+        return p
+
+    if headless:
+        for lib in [ "/usr/lib64", "/usr/lib" ]:
+            p = os.path.join(lib, "chromium-browser/headless_shell")
+            if os.access(p, os.X_OK):
+                return p
+
+    p = os.path.join(os.path.dirname(TEST_DIR), "node_modules/chromium/lib/chromium/chrome-linux/chrome")
+    if os.access(p, os.X_OK):
+        return p
+
+    raise RuntimeError("chromium-browser not found")
+
+
+def port_is_free(port):
+    """Check whether the local TCP port can be bound right now"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        return subprocess.check_output(["which", "chromium-browser"]).strip()
-    except subprocess.CalledProcessError:
-        if headless:
-            g = glob.glob("/usr/lib*/chromium-browser/headless_shell")
-            if g:
-                return g[0]
+        s.bind(("127.0.0.1", port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
 
-        p = os.path.join(os.path.dirname(TEST_DIR), "node_modules/chromium/lib/chromium/chrome-linux/chrome")
-        if os.access(p, os.X_OK):
-            return p
+_injected_source = None
 
-        raise
+def injected_source():
+    """Return the helper JS which gets injected into every page
+
+    This is read once per process. The scripts are concatenated, not wrapped
+    in a function, as their functions need to be global.
+    """
+    global _injected_source
+    if _injected_source is None:
+        sources = [ ]
+        for inject in [ "test-functions.js", "sizzle.js" ]:
+            with open(os.path.join(os.path.dirname(__file__), inject)) as f:
+                src = f.read()
+            # HACK: injecting sizzle fails on missing `document` in assert()
+            sources.append(src.replace('function assert( fn ) {', 'function assert( fn ) { return true;'))
+        _injected_source = "\n;\n".join(sources)
+    return _injected_source
 
 
+# strings which JSON encodes as themselves in quotes
+_SAFE_RE = re.compile(r'[A-Za-z0-9_./:-]*\Z')
+
 def jsquote(str):
+    # most quoted values are frame names, selectors, and such, which don't need escaping
+    try:
+        if _SAFE_RE.match(str):
+            return '"' + str + '"'
+    except TypeError:
+        pass
     return json.dumps(str)
 
+# compact JSON for CDP method arguments
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class Future(object):
+    """Result of a driver command which may not have been answered yet"""
+
+    def __init__(self, cdp, trace=False):
+        self.cdp = cdp
+        self.trace = trace
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def _set(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.done = True
+
+    def result(self):
+        """Wait for the reply and return it; raise RuntimeError on errors"""
+        if not self.done:
+            self.cdp._flush()
+        while not self.done:
+            self.cdp._read_reply()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.value
+
 
 class CDP:
     def __init__(self, lang=None, headless=True, verbose=False, trace=False, inject_helpers=True):
@@ -58,47 +142,98 @@ class CDP:
         self._browser = None
         self._browser_home = None
         self._cdp_port_lockfile = None
+        self._pending = collections.deque()
+        self._batching = 0
+        self._outbuf = [ ]
 
     def invoke(self, fn, **kwargs):
         """Call a particular CDP method such as Runtime.evaluate
 
         Use command() for arbitrary JS code.
         """
-        trace = self.trace and not kwargs.get("no_trace", False)
-        try:
-            del kwargs["no_trace"]
-        except KeyError:
-            pass
+        return self.invoke_async(fn, **kwargs).result()
 
-        cmd = fn + "(" + json.dumps(kwargs) + ")"
+    def invoke_async(self, fn, **kwargs):
+        """Send a CDP method call without waiting for its result
+
+        Returns a Future; several of these can be in flight at the same time.
+        """
+        no_trace = kwargs.pop("no_trace", False)
+        trace = self.trace and not no_trace
+
+        args = _encode(kwargs)
 
         # frame support for Runtime.evaluate(): map frame name to
-        # executionContextId and insert into argument object; this must not be quoted
+        # executionContextId and add it to the argument object; this must not be quoted
         # see "Frame tracking" in cdp-driver.js for how this works
         if fn == 'Runtime.evaluate' and self.cur_frame:
-            cmd = "%s, contextId: getFrameExecId(%s)%s" % (cmd[:-2], jsquote(self.cur_frame), cmd[-2:])
+            args = "%s%scontextId:getFrameExecId(%s)}" % (args[:-1], kwargs and "," or "", jsquote(self.cur_frame))
+
+        cmd = fn + "(" + args + ")"
 
         if trace:
             print("-> " + kwargs.get('trace', cmd))
 
         # avoid having to write the "client." prefix everywhere
         cmd = "client." + cmd
-        res = self.command(cmd)
-        if trace:
-            if "result" in res:
-                print("<- " + repr(res["result"]))
-            else:
-                print("<- " + repr(res))
-        return res
+        return self.command_async(cmd, trace=trace)
+
+    def invoke_many(self, calls):
+        """Send several CDP method calls at once without waiting for their results
+
+        calls is a list of (method, kwargs) pairs; returns a list of Futures.
+        """
+        with self.batch():
+            return [ self.invoke_async(fn, **kwargs) for (fn, kwargs) in calls ]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect the commands sent in this block and write them to the driver at once
+
+        Futures of commands in the batch can only be waited for after the
+        block; result() sends the batch early if needed.
+        """
+        self._batching += 1
+        try:
+            yield
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self._flush()
 
     def command(self, cmd):
+        return self.command_async(cmd).result()
+
+    def command_async(self, cmd, trace=False):
+        """Send arbitrary JS code to the driver without waiting for its result
+
+        The driver answers commands in the order in which they were sent, so
+        the replies are matched up with the pending Futures in that order.
+        """
         if not self._driver:
             self.start()
-        self._driver.stdin.write(cmd + "\n")
-        line = self._driver.stdout.readline()
+        self._outbuf.append(cmd + "\n")
+        future = Future(self, trace)
+        self._pending.append(future)
+        if not self._batching:
+            self._flush()
+        return future
+
+    def _flush(self):
+        if not self._outbuf:
+            return
+        data = "".join(self._outbuf)
+        self._outbuf = [ ]
+        fd = self._driver.stdin.fileno()
+        while data:
+            data = data[os.write(fd, data):]
+
+    def _read_reply(self):
+        line = self._driver and self._driver.stdout.readline()
         if not line:
             self.kill()
             raise RuntimeError("CDP broken")
+        future = self._pending.popleft()
         try:
             res = json.loads(line)
         except ValueError:
@@ -108,8 +243,15 @@ class CDP:
         if "error" in res:
             if self.trace:
                 print("<- raise " + res["error"])
-            raise RuntimeError(res["error"])
-        return res["result"]
+            future._set(error=res["error"])
+        else:
+            result = res["result"]
+            if future.trace:
+                if isinstance(result, dict) and "result" in result:
+                    print("<- " + repr(result["result"]))
+                else:
+                    print("<- " + repr(result))
+            future._set(value=result)
 
     def claim_port(self, port):
         f = None
@@ -126,13 +268,20 @@ class CDP:
     def find_cdp_port(self):
         """Find an unused port and claim it through lock file"""
 
-        for retry in range(100):
-            # don't use the default CDP port 9222 to avoid interfering with running browsers
-            port = random.randint (9223, 10222)
+        # don't use the default CDP port 9222 to avoid interfering with running browsers
+        first = 9223
+        count = 1000
+        # scan the whole range once, starting at a random place to avoid contention
+        start = random.randrange(count)
+        for i in range(count):
+            port = first + (start + i) % count
             if self.claim_port(port):
-                return port
-        else:
-            raise RuntimeError("unable to find free port")
+                # something which doesn't know about our lock files might be using it
+                if port_is_free(port):
+                    return port
+                self._cdp_port_lockfile.close()
+                self._cdp_port_lockfile = None
+        raise RuntimeError("unable to find free port")
 
     def start(self):
         environ = os.environ.copy()
@@ -153,14 +302,10 @@ class CDP:
             # start browser on a new port
             cdp_port = self.find_cdp_port()
             self._browser_home = tempfile.mkdtemp()
-            environ = os.environ.copy()
             environ["HOME"] = self._browser_home
             environ["LC_ALL"] = "C.utf8"
             # this might be set for the tests themselves, but we must isolate caching between tests
-            try:
-                del environ["XDG_CACHE_HOME"]
-            except KeyError:
-                pass
+            environ.pop("XDG_CACHE_HOME", None)
 
             exe = browser_path(self.headless)
 
@@ -180,15 +325,20 @@ class CDP:
                 sys.stderr.write("Started %s (pid %i) on port %i\n" % (exe, self._browser.pid, cdp_port))
 
         # wait for CDP to be up
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        for retry in range(300):
+        deadline = time.time() + 30
+        delay = 0.01
+        while True:
             try:
-                s.connect(('127.0.0.1', cdp_port))
+                socket.create_connection(('127.0.0.1', cdp_port), timeout=0.05).close()
                 break
             except socket.error:
-                time.sleep(0.1)
-        else:
-            raise RuntimeError('timed out waiting for browser to start')
+                # don't wait for a browser that crashed
+                if self._browser and self._browser.poll() is not None:
+                    raise RuntimeError('browser exited with code %i during startup' % self._browser.returncode)
+                if time.time() >= deadline:
+                    raise RuntimeError('timed out waiting for browser to start')
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
 
         # now start the driver
         if self.trace:
@@ -202,16 +352,13 @@ class CDP:
         self.valid = True
 
         if self.inject_helpers:
-            for inject in [ "%s/test-functions.js" % path, "%s/sizzle.js" % path ]:
-                with open(inject) as f:
-                    src = f.read()
-                # HACK: injecting sizzle fails on missing `document` in assert()
-                src = src.replace('function assert( fn ) {', 'function assert( fn ) { return true;')
-                self.invoke("Page.addScriptToEvaluateOnLoad", scriptSource=src, no_trace=True)
+            self.invoke("Page.addScriptToEvaluateOnLoad", scriptSource=injected_source(), no_trace=True)
 
     def kill(self):
         self.valid = False
         self.cur_frame = None
+        self._pending.clear()
+        self._outbuf = [ ]
         if self._driver:
             self._driver.stdin.close()
             self._driver.wait()
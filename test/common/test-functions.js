@@ -183,6 +183,17 @@ function ph_focus(sel)
     ph_find(sel).focus();
 }
 
+// Fill in and submit the login form; AUTHORIZED can be null to leave the
+// checkbox alone.
+function ph_login(user, password, authorized)
+{
+    ph_set_val("#login-user-input", user);
+    ph_set_val("#login-password-input", password);
+    if (authorized !== null)
+        ph_set_checked("#authorized-input", authorized);
+    ph_click("#login-button");
+}
+
 // Convert return value from a JS expression into a standard JS Promise, so
 // that it can be processed by CDP Runtime.evaluate() with awaitPromise=true.
 function ph_wrap_promise(value) {
@@ -227,3 +238,11 @@ function ph_wait_cond(cond, timeout) {
         step();
     });
 }
+
+// Table of the helpers above, without their "ph_" prefix. testlib.py calls
+// them as __ph.click(...), which is a single property lookup on each call.
+var __ph = { };
+Object.keys(window).forEach(name => {
+    if (name.indexOf("ph_") === 0)
+        __ph[name.slice(3)] = window[name];
+});
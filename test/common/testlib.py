@@ -26,10 +26,12 @@ from time import sleep
 import argparse
 import base64
 import errno
+import fcntl
 import subprocess
 import os
 import select
 import shutil
+import signal
 import socket
 import sys
 import traceback
@@ -37,8 +39,8 @@ import random
 import re
 import json
 import tempfile
+import threading
 import time
-import signal
 import unittest
 
 import tap
@@ -48,7 +50,13 @@ import cdp
 TEST_DIR = os.path.normpath(os.path.dirname(os.path.realpath(os.path.join(__file__, ".."))))
 BOTS_DIR = os.path.normpath(os.path.join(TEST_DIR, "..", "bots"))
 
-os.environ["PATH"] = "{0}:{1}:{2}".format(os.environ.get("PATH"), BOTS_DIR, TEST_DIR)
+# Only add what's missing, so that re-importing (e.g. in child processes) doesn't grow PATH
+_path = [ d for d in os.environ.get("PATH", "").split(":") if d ]
+os.environ["PATH"] = ":".join(_path + [ d for d in (BOTS_DIR, TEST_DIR) if d not in _path ])
+
+# Helpers in test-functions.js which are available through its __ph table
+with open(os.path.join(TEST_DIR, "common", "test-functions.js")) as f:
+    PH_FUNCTIONS = frozenset(re.findall(r"^function\s+ph_(\w+)", f.read(), re.M))
 
 __all__ = (
     # Test definitions
@@ -79,8 +87,85 @@ def attach(filename):
     if not opts.attachments:
         return
     dest = os.path.join(opts.attachments, os.path.basename(filename))
-    if os.path.exists(filename) and not os.path.exists(dest):
-        shutil.move(filename, dest)
+    try:
+        os.rename(filename, dest)
+    except OSError as ex:
+        if ex.errno == errno.EXDEV:
+            shutil.move(filename, dest)
+        elif ex.errno not in (errno.ENOENT, errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+class BatchResult(object):
+    """Return value of a Browser.call_js_func() inside Browser.batch()
+
+    The value is only available after the batch block exits.
+    """
+    def __init__(self):
+        self.value = None
+
+class BrowserBatch(object):
+    def __init__(self, browser, merge_waits=True):
+        self.browser = browser
+        self.merge_waits = merge_waits
+        self.outer = None
+        # list of ("call", code, BatchResult) and ("wait", [cond, ...], timeout)
+        self.steps = [ ]
+
+    def __enter__(self):
+        # a nested batch joins the outer one, and runs everything collected so far when it ends
+        self.outer = self.browser._batch
+        if self.outer is None:
+            self.browser._batch = self
+        else:
+            (self.merge_waits, self.outer.merge_waits) = (self.outer.merge_waits, self.merge_waits)
+        return self.browser._batch
+
+    def __exit__(self, type, value, traceback):
+        if self.outer is None:
+            self.browser._batch = None
+        else:
+            self.outer.merge_waits = self.merge_waits
+        if type is None:
+            (self.outer or self).flush()
+
+    def call(self, code):
+        result = BatchResult()
+        self.steps.append(("call", code, result))
+        return result
+
+    def wait(self, cond):
+        timeout = self.browser.cdp.timeout
+        if self.merge_waits and self.steps and self.steps[-1][0] == "wait" and self.steps[-1][2] == timeout:
+            self.steps[-1][1].append(cond)
+        else:
+            self.steps.append(("wait", [cond], timeout))
+
+    def flush(self):
+        if not self.steps:
+            return
+        body = [ ]
+        results = [ ]
+        for (kind, arg, extra) in self.steps:
+            if kind == "call":
+                body.append("r.push(await ph_wrap_promise(%s));" % arg)
+                results.append(extra)
+            else:
+                cond = " && ".join(map(lambda c: "(%s)" % c, arg))
+                body.append("await ph_wait_cond(() => %s, %i);" % (cond, extra * 1000))
+        code = "(async function() { var r = [ ]; %s return r; })()" % " ".join(body)
+        self.steps = [ ]
+
+        ret = self.browser.cdp.invoke("Runtime.evaluate", expression=code, trace="batch: " + code,
+                                      silent=False, awaitPromise=True, returnByValue=True)
+        if "exceptionDetails" in ret:
+            details = ret["exceptionDetails"]
+            if details.get("exception", {}).get("value") == "condition did not become true":
+                trailer = "\n".join(self.browser.cdp.get_js_log())
+                self.browser.raise_cdp_exception("timeout\nbatch", code, details, trailer)
+            self.browser.raise_cdp_exception("batch", code, details)
+        values = ret.get("result", {}).get("value") or [ ]
+        for (result, value) in zip(results, values):
+            result.value = value
 
 class Browser:
     def __init__(self, address, label, port=None, headless=True):
@@ -95,6 +180,8 @@ class Browser:
         self.label = label
         self.cdp = cdp.CDP("C.utf8", headless, verbose=opts.trace, trace=opts.trace)
         self.password = "foobar"
+        self._batch = None
+        self._cookie_cache = (0, None)
 
     def title(self):
         return self.cdp.eval('document.title')
@@ -114,29 +201,47 @@ class Browser:
         if href.startswith("/"):
             href = "http://%s:%s%s" % (self.address, self.port, href)
 
+        self.switch_to_top()
         if cookie:
             self.cdp.invoke("Network.setCookie", **cookie)
-        self.switch_to_top()
         self.cdp.invoke("Page.navigate", url=href)
         self.expect_load()
 
     def reload(self, ignore_cache=False):
         self.switch_to_top()
         self.wait_js_cond("ph_select('iframe.container-frame').every(function (e) { return e.getAttribute('data-loaded'); })")
+        self.flush_batch()
         self.cdp.invoke("Page.reload", ignoreCache=ignore_cache)
         self.expect_load()
 
-    def expect_load(self):
+    def expect_load(self, trigger=None):
+        """Wait for the page to load
+
+        If given, the JS expression TRIGGER is evaluated in the page once the
+        load is being waited for, so that a load caused by it cannot be missed.
+        """
+        self.flush_batch()
         if opts.trace:
             print("-> expect_load")
+        if trigger:
+            trigger = 'client.Runtime.evaluate({ expression: %s, returnByValue: true }).then(r => { \
+                let ex = r.exceptionDetails; \
+                if (ex) { \
+                    clearTimeout(tm); \
+                    reject((ex.exception && (ex.exception.value || ex.exception.description)) || ex.text); \
+                } \
+            }, reject);' % jsquote(trigger)
         self.cdp.command('new Promise((resolve, reject) => { \
             let tm = setTimeout( () => reject("timed out waiting for page load"), %i ); \
             client.Page.loadEventFired( () => { clearTimeout(tm); resolve() }); \
-        })' % (self.cdp.timeout * 1000))
+            %s \
+        })' % (self.cdp.timeout * 1000, trigger or ""))
+        self._cookie_cache = (0, None)
         if opts.trace:
             print("<- expect_load done")
 
     def expect_load_frame(self, name):
+        self.flush_batch()
         if opts.trace:
             print("-> expect_load_frame " + name)
         self.cdp.command('expectLoadFrame(%s, %i)' % (jsquote(name), self.cdp.timeout * 1000))
@@ -144,15 +249,26 @@ class Browser:
             print("<- expect_load_frame %s done" % name)
 
     def switch_to_frame(self, name):
+        # batched steps run in the frame that is current when they get sent
+        self.flush_batch()
         self.cdp.set_frame(name)
 
     def switch_to_top(self):
+        self.flush_batch()
         self.cdp.set_frame(None)
 
     def upload_file(self, selector, file):
-        r = self.cdp.invoke("Runtime.evaluate", expression='document.querySelector(%s)' % jsquote(selector))
-        objectId = r["result"]["objectId"]
-        self.cdp.invoke("DOM.setFileInputFiles", files=[file], objectId=objectId)
+        self.flush_batch()
+        # look up the element and set its files in a single driver command
+        context = ""
+        if self.cdp.cur_frame:
+            context = ", contextId: getFrameExecId(%s)" % jsquote(self.cdp.cur_frame)
+        expression = 'document.querySelector(%s)' % jsquote(selector)
+        if opts.trace:
+            print("-> upload_file %s %s" % (selector, file))
+        self.cdp.command("client.Runtime.evaluate({expression: %s%s}).then(r => "
+                         "client.DOM.setFileInputFiles({files: %s, objectId: r.result.objectId}))" %
+                         (jsquote(expression), context, json.dumps([file])))
 
     def raise_cdp_exception(self, func, arg, details, trailer=None):
         # unwrap a typical error string
@@ -165,6 +281,7 @@ class Browser:
         raise Error("%s(%s): %s" % (func, arg, msg))
 
     def eval_js(self, code, no_trace=False):
+        self.flush_batch()
         result = self.cdp.invoke("Runtime.evaluate", expression="ph_wrap_promise(%s)" % code, trace=code,
                                  silent=False, awaitPromise=True, returnByValue=True, no_trace=no_trace)
         if "exceptionDetails" in result:
@@ -182,14 +299,59 @@ class Browser:
         return None
 
     def call_js_func(self, func, *args):
-        return self.eval_js("%s(%s)" % (func, ','.join(map(jsquote, args))))
+        code = "%s(%s)" % (ph_func(func), jsquote_args(args))
+        if self._batch is not None:
+            return self._batch.call(code)
+        return self.eval_js(code)
+
+    def query_js_func(self, func, *args):
+        """Like call_js_func(), but always return the value, also inside a batch"""
+        return self.eval_js("%s(%s)" % (ph_func(func), jsquote_args(args)))
+
+    def batch(self, merge_waits=True):
+        """Collect helper calls and waits, and run them in a single round-trip.
+
+        Inside the block, call_js_func() returns a BatchResult whose value
+        gets filled in when the block exits, and the wait_*() helpers queue
+        their conditions. Consecutive waits are merged into one condition,
+        which needs all of them to hold at the same time; with merge_waits=False
+        they are waited for one after the other. The first failure raises Error.
+
+        Everything else that talks to the browser, like eval_js(), the
+        query helpers such as is_visible() or text(), key_press(), frame
+        switches or page loads, first runs what has been collected so far,
+        so things still happen in order. Direct calls of self.cdp don't;
+        call flush_batch() before them. A nested batch joins the outer one,
+        and runs what has been collected when it ends.
+
+        Example:
+            with b.batch():
+                b.click("#button")
+                b.wait_visible("#dialog")
+                b.wait_visible("#dialog .btn-primary")
+        """
+        return BrowserBatch(self, merge_waits)
 
-    def cookie(self, name):
+    def flush_batch(self):
+        """Run what the current batch has collected so far, if there is one"""
+        if self._batch is not None:
+            self._batch.flush()
+
+    def cookies(self):
+        """Return all cookies of the current page as a dict mapping names to values"""
+        self.flush_batch()
         cookies = self.cdp.invoke("Network.getCookies")
-        for c in cookies["cookies"]:
-            if c["name"] == name:
-                return c["value"]
-        return None
+        result = dict(map(lambda c: (c["name"], c["value"]), cookies["cookies"]))
+        self._cookie_cache = (time.time(), result)
+        return result
+
+    def cookie(self, name):
+        # several cookies are often checked in a row, so reuse a recent result
+        self.flush_batch()
+        (timestamp, cookies) = self._cookie_cache
+        if cookies is None or time.time() - timestamp > 0.2:
+            cookies = self.cookies()
+        return cookies.get(name)
 
     def go(self, hash, host="localhost"):
         # if not hash.startswith("/@"):
@@ -200,16 +362,16 @@ class Browser:
         self.call_js_func('ph_click', selector, force)
 
     def val(self, selector):
-        return self.call_js_func('ph_val', selector)
+        return self.query_js_func('ph_val', selector)
 
     def set_val(self, selector, val):
         self.call_js_func('ph_set_val', selector, val)
 
     def text(self, selector):
-        return self.call_js_func('ph_text', selector)
+        return self.query_js_func('ph_text', selector)
 
     def attr(self, selector, attr):
-        return self.call_js_func('ph_attr', selector, attr)
+        return self.query_js_func('ph_attr', selector, attr)
 
     def set_attr(self, selector, attr, val):
         self.call_js_func('ph_set_attr', selector, attr, val and 'true' or 'false')
@@ -221,8 +383,16 @@ class Browser:
         self.call_js_func('ph_focus', selector)
 
     def key_press(self, keys):
-        for k in keys:
-            self.cdp.invoke("Input.dispatchKeyEvent", type="char", text=k)
+        # Send all key events with a single driver command instead of one round-trip per key.
+        # Input.insertText would be even cheaper, but it does not generate keypress events,
+        # which e. g. the terminal relies on.
+        if not keys:
+            return
+        self.flush_batch()
+        if opts.trace:
+            print("-> key_press %r" % (keys,))
+        events = map(lambda k: "client.Input.dispatchKeyEvent(%s)" % json.dumps({"type": "char", "text": k}), keys)
+        self.cdp.command(".then(() => ".join(events) + ")" * (len(keys) - 1))
 
     def wait_timeout(self, timeout):
         browser = self
@@ -238,19 +408,26 @@ class Browser:
         return r
 
     def wait(self, predicate):
-        def alarm_handler(signum, frame):
-            raise Error('timed out waiting for predicate to become true')
+        """Wait for a Python predicate to become true.
 
-        signal.signal(signal.SIGALRM, alarm_handler)
-        orig_handler = signal.alarm(self.cdp.timeout)
-        while True:
+        This polls from the test process, so only use it for conditions
+        outside of the browser, like files or processes on the machine.
+        Conditions on the page should use wait_js() or the wait_*() helpers,
+        which are evaluated within the browser.
+        """
+        self.flush_batch()
+        deadline = time.time() + self.cdp.timeout
+        while time.time() < deadline:
             val = predicate()
             if val:
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, orig_handler)
                 return val
+            time.sleep(0.1)
+        raise Error('timed out waiting for predicate to become true')
 
     def wait_js_cond(self, cond):
+        if self._batch is not None:
+            self._batch.wait(cond)
+            return
         result = self.cdp.invoke("Runtime.evaluate",
                                  expression="ph_wait_cond(() => %s, %i)" % (cond, self.cdp.timeout * 1000),
                                  silent=False, awaitPromise=True, trace="wait: " + cond)
@@ -258,11 +435,15 @@ class Browser:
             trailer = "\n".join(self.cdp.get_js_log())
             self.raise_cdp_exception("timeout\nwait_js_cond", cond, result["exceptionDetails"], trailer)
 
+    def wait_js(self, expr):
+        """Wait for a JavaScript expression to become true on the page."""
+        self.wait_js_cond(expr)
+
     def wait_js_func(self, func, *args):
-        self.wait_js_cond("%s(%s)" % (func, ','.join(map(jsquote, args))))
+        self.wait_js_cond("%s(%s)" % (ph_func(func), jsquote_args(args)))
 
     def is_present(self, selector):
-        return self.call_js_func('ph_is_present', selector)
+        return self.query_js_func('ph_is_present', selector)
 
     def wait_present(self, selector):
         return self.wait_js_func('ph_is_present', selector)
@@ -271,7 +452,7 @@ class Browser:
         return self.wait_js_func('!ph_is_present', selector)
 
     def is_visible(self, selector):
-        return self.call_js_func('ph_is_visible', selector)
+        return self.query_js_func('ph_is_visible', selector)
 
     def wait_visible(self, selector):
         return self.wait_js_func('ph_is_visible', selector)
@@ -323,14 +504,14 @@ class Browser:
         self.click(sel + " " + button)
         self.wait_not_present(sel + " .dialog-wait-ct")
 
-        dialog_visible = self.call_js_func('ph_is_visible', sel)
+        dialog_visible = self.query_js_func('ph_is_visible', sel)
         if result == "hide":
             if dialog_visible:
                 raise AssertionError(sel + " dialog did not complete and close")
         elif result == "fail":
             if not dialog_visible:
                 raise AssertionError(sel + " dialog is closed no failures present")
-            dialog_error = self.call_js_func('ph_is_present', sel + " .dialog-error")
+            dialog_error = self.query_js_func('ph_is_present', sel + " .dialog-error")
             if not dialog_error:
                 raise AssertionError(sel + " dialog has no errors")
         else:
@@ -358,9 +539,11 @@ class Browser:
 
         while True:
             try:
-                self.wait_present("iframe.container-frame[name='%s'][data-loaded]" % frame)
-                self.wait_not_visible(".curtains-ct")
-                self.wait_visible("iframe.container-frame[name='%s']" % frame)
+                # one round-trip, but these need to happen one after the other
+                with self.batch(merge_waits=False):
+                    self.wait_present("iframe.container-frame[name='%s'][data-loaded]" % frame)
+                    self.wait_not_visible(".curtains-ct")
+                    self.wait_visible("iframe.container-frame[name='%s']" % frame)
                 break
             except Error as ex:
                 if reconnect and ex.msg.startswith('timeout'):
@@ -372,8 +555,9 @@ class Browser:
                 raise
 
         self.switch_to_frame(frame)
-        self.wait_present("body")
-        self.wait_visible("body")
+        with self.batch():
+            self.wait_present("body")
+            self.wait_visible("body")
 
     def leave_page(self):
         self.switch_to_top()
@@ -399,17 +583,18 @@ class Browser:
             href = "/@" + host + href
         self.open(href)
         self.wait_visible("#login")
-        self.set_val('#login-user-input', user)
-        self.set_val('#login-password-input', self.password)
-        self.set_checked('#authorized-input', authorized)
-
-        self.click('#login-button')
-        self.expect_load()
-        self.wait_present('#content')
-        self.wait_visible('#content')
+        self._submit_login(user, authorized)
         if path:
             self.enter_page(path.split("#")[0], host=host)
 
+    def _submit_login(self, user, authorized):
+        if opts.trace:
+            print("-> login %s" % user)
+        self.expect_load(trigger="%s(%s)" % (ph_func("ph_login"), jsquote_args([ user, self.password, authorized ])))
+        with self.batch():
+            self.wait_present('#content')
+            self.wait_visible('#content')
+
     def logout(self):
         self.switch_to_top()
         self.wait_present("#navbar-dropdown")
@@ -426,20 +611,14 @@ class Browser:
         # HACK: this got fixed in 6c1f4ffcab24d, not in RHEL 7.4 base yet
         if os.getenv("TEST_OS") == "rhel-7-4":
             self.cdp.invoke("Network.clearBrowserCookies")
+            self._cookie_cache = (0, None)
 
     def relogin(self, path=None, user=None, authorized=None):
         if user is None:
             user = self.default_user
         self.logout()
         self.wait_visible("#login")
-        self.set_val("#login-user-input", user)
-        self.set_val("#login-password-input", self.password)
-        if authorized is not None:
-            self.set_checked('#authorized-input', authorized)
-        self.click('#login-button')
-        self.expect_load()
-        self.wait_present('#content')
-        self.wait_visible('#content')
+        self._submit_login(user, authorized)
         if path:
             if path.startswith("/@"):
                 host = path[2:].split("/")[0]
@@ -451,6 +630,7 @@ class Browser:
         action = ignore and "continue" or "cancel"
         if opts.trace:
             print("-> Setting SSL certificate error policy to %s" % action)
+        self.flush_batch()
         self.cdp.command("new Promise((resolve, _) => { ssl_bad_certificate_action = '%s'; resolve() })" % action)
 
     def snapshot(self, title, label=None):
@@ -460,8 +640,14 @@ class Browser:
             title: Used for the filename.
         """
         if self.cdp and self.cdp.valid:
+            # let the browser produce both at the same time
+            (screenshot, dump) = self.cdp.invoke_many([
+                ("Page.captureScreenshot", { "no_trace": True }),
+                ("Runtime.evaluate", { "expression": "document.documentElement.outerHTML", "no_trace": True })
+            ])
+
             filename = "{0}-{1}.png".format(label or self.label, title)
-            ret = self.cdp.invoke("Page.captureScreenshot", no_trace=True)
+            ret = screenshot.result()
             if "data" in ret:
                 with open(filename, 'wb') as f:
                     f.write(base64.standard_b64decode(ret["data"]))
@@ -471,8 +657,7 @@ class Browser:
                 print("Screenshot not available")
 
             filename = "{0}-{1}.html".format(label or self.label, title)
-            html = self.cdp.invoke("Runtime.evaluate", expression="document.documentElement.outerHTML",
-                                   no_trace=True)["result"]["value"]
+            html = dump.result()["result"]["value"]
             with open(filename, 'wb') as f:
                 f.write(html.encode('UTF-8'))
             attach(filename)
@@ -491,7 +676,7 @@ class Browser:
         logs = self.get_js_log()
         if logs:
             filename = "{0}-{1}.js.log".format(label or self.label, title)
-            with open(filename, 'w') as f:
+            with open(filename, 'wb') as f:
                 f.write('\n'.join(logs).encode('UTF-8'))
             attach(filename)
             print("Wrote JS log to " + filename)
@@ -508,6 +693,7 @@ class MachineCase(unittest.TestCase):
     machine_class = None
     browser = None
     network = None
+    _allowed_buckets = None
 
     # provision is a dictionary of dictionaries, one for each additional machine to be created, e.g.:
     # provision = { 'openshift' : { 'image': 'openshift', 'memory_mb': 1024 } }
@@ -553,16 +739,18 @@ class MachineCase(unittest.TestCase):
     def checkSuccess(self):
         if not self.currentResult:
             return False
-        for error in self.currentResult.errors:
+        # only look at the entries added since this test started, see run()
+        (errors, failures, unexpected, skipped) = self.currentResultMarks
+        for error in self.currentResult.errors[errors:]:
             if self == error[0]:
                 return False
-        for failure in self.currentResult.failures:
+        for failure in self.currentResult.failures[failures:]:
             if self == failure[0]:
                 return False
-        for success in self.currentResult.unexpectedSuccesses:
+        for success in self.currentResult.unexpectedSuccesses[unexpected:]:
             if self == success:
                 return False
-        for skipped in self.currentResult.skipped:
+        for skipped in self.currentResult.skipped[skipped:]:
             if self == skipped[0]:
                 return False
         return True
@@ -578,6 +766,8 @@ class MachineCase(unittest.TestCase):
                 startTestRun()
 
         self.currentResult = result
+        self.currentResultMarks = (len(result.errors), len(result.failures),
+                                   len(result.unexpectedSuccesses), len(result.skipped))
 
         # Here's the loop to actually retry running the test. It's an awkward
         # place for this loop, since it only applies to MachineCase based
@@ -614,21 +804,24 @@ class MachineCase(unittest.TestCase):
         provision = self.provision or { 'machine1': { } }
 
         # First create all machines, wait for them later
-        for key in sorted(provision.keys()):
-            options = provision[key].copy()
-            if 'address' in options:
-                del options['address']
-            if 'dns' in options:
-                del options['dns']
-            if 'dhcp' in options:
-                del options['dhcp']
-            machine = self.new_machine(**options)
+        provisioned = [ ]
+        for (key, options) in sorted(provision.items()):
+            machine_options = options.copy()
+            for option in [ 'address', 'dns', 'dhcp' ]:
+                machine_options.pop(option, None)
+            machine = self.new_machine(**machine_options)
             self.machines[key] = machine
             if not self.machine:
                 self.machine = machine
             if opts.trace:
                 print("Starting {0} {1}".format(key, machine.label))
-            machine.start()
+            provisioned.append((key, machine, options))
+
+        # Starting a machine is slow, so start them all at once. Waiting for
+        # them happens serially below, as the machines boot concurrently
+        # anyway, and testvm.Timeout relies on SIGALRM, which only works in
+        # the main thread.
+        parallel_map(lambda p: p[1].start(), provisioned)
 
         def sitter():
             if opts.sit and not self.checkSuccess():
@@ -636,17 +829,20 @@ class MachineCase(unittest.TestCase):
                 sit(self.machines)
         self.addCleanup(sitter)
 
-        # Now wait for the other machines to be up
-        for key in self.machines.keys():
-            machine = self.machines[key]
-            machine.wait_boot()
-            address = provision[key].get("address")
+        # Now wait for the other machines to be up; all share one deadline
+        deadline = time.time() + 120
+        if len(provisioned) > 1:
+            self._wait_ssh_multi(map(lambda p: p[1], provisioned), deadline)
+        for (key, machine, options) in provisioned:
+            # leave some time even to machines which only just came up
+            machine.wait_boot(timeout_sec=max(deadline - time.time(), 15))
+            address = options.get("address")
             if address is not None:
                 machine.set_address(address)
-            dns = provision[key].get("dns")
+            dns = options.get("dns")
             if address or dns:
                 machine.set_dns(dns)
-            dhcp = provision[key].get("dhcp", False)
+            dhcp = options.get("dhcp", False)
             if dhcp:
                 machine.dhcp_server()
 
@@ -662,6 +858,41 @@ class MachineCase(unittest.TestCase):
                 self.copy_cores("FAIL")
         self.addCleanup(intercept)
 
+    def _wait_ssh_multi(self, machines, deadline):
+        """Wait until all machines accept ssh logins, or until DEADLINE
+
+        This probes all machines at the same time, with one ssh process per
+        machine, and select()s on all of them. Afterwards wait_boot() finds
+        the machines up and returns quickly; machines which did not come up
+        in time are left to wait_boot() to report.
+        """
+        procs = { }
+        pending = list(machines)
+        with open(os.devnull, 'w') as devnull:
+            while pending or procs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                for machine in pending:
+                    proc = machine.start_ssh_probe(stdin=devnull, stdout=subprocess.PIPE, stderr=devnull)
+                    procs[proc.stdout.fileno()] = (machine, proc)
+                pending = [ ]
+
+                # the probes don't print anything, so their stdout becomes readable on exit
+                (ready, unused, unused) = select.select(list(procs.keys()), [ ], [ ], remaining)
+                for fd in ready:
+                    (machine, proc) = procs.pop(fd)
+                    proc.stdout.close()
+                    if proc.wait() != 0:
+                        pending.append(machine)
+                if pending:
+                    time.sleep(1)
+
+        for (machine, proc) in procs.values():
+            proc.terminate()
+            proc.stdout.close()
+            proc.wait()
+
     def tearDown(self):
         if self.checkSuccess() and self.machine.ssh_reachable:
             self.check_journal_messages()
@@ -732,6 +963,48 @@ class MachineCase(unittest.TestCase):
         """Don't fail if the journal containes a entry matching the given regexp"""
         for p in patterns:
             self.allowed_messages.append(p)
+        if self._allowed_buckets is not None:
+            self._index_allowed_messages(patterns)
+
+    def _index_allowed_messages(self, patterns):
+        """Add patterns to the index of allowed messages and recompile the affected regexps
+
+        Patterns without any regexp syntax go into the _allowed_literals set.
+        The others are grouped by their literal first word; each group is compiled
+        into one regexp in _allowed_buckets, all other patterns into _allowed_fallback.
+        """
+        changed = set()
+        for p in patterns:
+            if is_literal(p):
+                self._allowed_literals.add(p)
+                continue
+            word = literal_first_word(p)
+            if word:
+                self._allowed_words.setdefault(word, [ ]).append(p)
+            else:
+                self._allowed_other.append(p)
+            changed.add(word)
+        for word in changed:
+            if word:
+                self._allowed_buckets[word] = compile_full_match(self._allowed_words[word])
+            else:
+                self._allowed_fallback = compile_full_match(self._allowed_other)
+
+    def _is_allowed_message(self, message):
+        if self._allowed_buckets is None:
+            self._allowed_literals = set()
+            self._allowed_words = { }
+            self._allowed_other = [ ]
+            self._allowed_buckets = { }
+            self._allowed_fallback = None
+            self._index_allowed_messages(self.allowed_messages)
+        if message in self._allowed_literals:
+            return True
+        words = message.split(None, 1)
+        bucket = words and self._allowed_buckets.get(words[0])
+        if bucket and bucket.match(message):
+            return True
+        return self._allowed_fallback is not None and self._allowed_fallback.match(message) is not None
 
     def allow_hostkey_messages(self):
         self.allow_journal_messages('.*: .* host key for server is not known: .*',
@@ -779,18 +1052,12 @@ class MachineCase(unittest.TestCase):
         syslog_ids = [ "cockpit-ws", "cockpit-bridge" ]
         messages = machine.journal_messages(syslog_ids, 5)
         messages += machine.audit_messages("14") # 14xx is selinux
+        # remove leading/trailing whitespace
+        messages = [ m.strip() for m in messages ]
         all_found = True
         first = None
         for m in messages:
-            # remove leading/trailing whitespace
-            m = m.strip()
-            found = False
-            for p in self.allowed_messages:
-                match = re.match(p, m)
-                if match and match.group(0) == m:
-                    found = True
-                    break
-            if not found:
+            if not self._is_allowed_message(m):
                 print("Unexpected journal message '%s'" % m)
                 all_found = False
                 if not first:
@@ -821,37 +1088,136 @@ class MachineCase(unittest.TestCase):
         if self.browser is not None:
             self.browser.copy_js_log(title, label)
 
+    def _connected_machines(self):
+        """Return the reachable machines, with their ssh connections set up
+
+        Connecting uses testvm.Timeout, which only works in the main thread, so
+        this needs to happen before working on the machines in parallel_map().
+        """
+        machines = [ m for m in self.machines.values() if m.ssh_reachable ]
+        for m in machines:
+            m._ensure_ssh_master()
+        return machines
+
     def copy_journal(self, title, label=None):
-        for name, m in self.machines.iteritems():
-            if m.ssh_reachable:
-                log = "%s-%s-%s.log" % (label or self.label(), m.label, title)
-                with open(log, "w") as fp:
+        def copy(m):
+            log = "%s-%s-%s.log" % (label or self.label(), m.label, title)
+            with open(log, "w") as fp, open(os.devnull, "w") as devnull:
+                # compress on the machine, that's a lot less to push through ssh;
+                # without gzip on the machine this sends nothing, and decompressing fails quietly
+                gunzip = subprocess.Popen([ "gzip", "-dc" ], stdin=subprocess.PIPE, stdout=fp, stderr=devnull,
+                                          close_fds=True)
+                m.execute("command -v gzip >/dev/null && journalctl | gzip -1", stdout=gunzip.stdin)
+                gunzip.stdin.close()
+                if gunzip.wait() != 0:
+                    fp.seek(0)
+                    fp.truncate()
                     m.execute("journalctl", stdout=fp)
-                    print("Journal extracted to %s" % (log))
-                    attach(log)
+            with output_lock:
+                print("Journal extracted to %s" % (log))
+                attach(log)
+        parallel_map(copy, self._connected_machines())
 
     def copy_cores(self, title, label=None):
-        for name, m in self.machines.iteritems():
-            if m.ssh_reachable:
-                directory = "%s-%s-%s.core" % (label or self.label(), m.label, title)
-                dest = os.path.abspath(directory)
-                m.download_dir("/var/lib/systemd/coredump", dest)
-                try:
-                    os.rmdir(dest)
-                except OSError as ex:
-                    if ex.errno == errno.ENOTEMPTY:
+        def copy(m):
+            directory = "%s-%s-%s.core" % (label or self.label(), m.label, title)
+            dest = os.path.abspath(directory)
+            m.download_dir("/var/lib/systemd/coredump", dest)
+            try:
+                os.rmdir(dest)
+            except OSError as ex:
+                if ex.errno == errno.ENOTEMPTY:
+                    with output_lock:
                         print("Core dumps downloaded to %s" % (dest))
                         attach(dest)
+        parallel_map(copy, self._connected_machines())
 
 some_failed = False
 
-def jsquote(str):
-    return json.dumps(str)
+# serializes output of code that runs in parallel_map()
+output_lock = threading.Lock()
+
+def parallel_map(func, items):
+    """Call FUNC for each of ITEMS in a separate thread and wait for all of them.
+
+    Returns the list of results. If any call raised an exception, the first
+    one is re-raised after all calls have finished.
+    """
+    items = list(items)
+    if len(items) == 1:
+        return [ func(items[0]) ]
+
+    results = [ None ] * len(items)
+    errors = [ ]
+
+    def run(i, item):
+        try:
+            results[i] = func(item)
+        except BaseException:
+            errors.append(sys.exc_info())
+
+    threads = [ threading.Thread(target=run, args=(i, item)) for (i, item) in enumerate(items) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        reraise(errors[0])
+    return results
+
+# re-raise an exception from sys.exc_info() with its original traceback
+if sys.version_info[0] >= 3:
+    def reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec("def reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n")
+
+jsquote = cdp.jsquote
+
+def jsquote_args(args):
+    """Quote a sequence of values as a JavaScript argument list, with a single json.dumps call"""
+    return json.dumps(list(args), separators=(',', ':'))[1:-1]
+
+def compile_full_match(patterns):
+    """Compile a list of regexps into one that only matches if one of them matches a whole string
+
+    Returns None for an empty list.
+    """
+    if not patterns:
+        return None
+    return re.compile("(?:%s)\\Z" % "|".join(map(lambda p: "(?:%s)" % p, patterns)))
+
+REGEXP_SYNTAX = r"[.^$*+?{}\[\]\\|()]"
+
+def is_literal(pattern):
+    """Check whether a regexp only matches itself"""
+    return re.search(REGEXP_SYNTAX, pattern) is None
+
+def literal_first_word(pattern):
+    """Return the first word that every match of a regexp starts with, or None if it is not literal"""
+    if "|" in pattern:
+        return None
+    literal = re.split(REGEXP_SYNTAX, pattern, 1)[0]
+    space = literal.find(" ")
+    # the space must not be last, otherwise a quantifier might apply to it
+    if space > 0 and space < len(literal) - 1:
+        return literal[:space]
+    return None
+
+def ph_func(func):
+    """Refer to a test-functions.js helper such as "ph_click" or "!ph_is_present" through the __ph table"""
+    match = re.match(r"(!?)ph_(\w+)$", func)
+    if match and match.group(2) in PH_FUNCTIONS:
+        return "%s__ph.%s" % match.groups()
+    return func
+
+def _identity(func):
+    return func
 
 def skipImage(reason, *args):
     if testvm.DEFAULT_IMAGE in args:
         return unittest.skip("{0}: {1}".format(testvm.DEFAULT_IMAGE, reason))
-    return lambda func: func
+    return _identity
 
 class TestResult(tap.TapResult):
     def __init__(self, stream, descriptions, verbosity):
@@ -868,42 +1234,88 @@ class TestResult(tap.TapResult):
         sys.stdout.flush()
         super(TestResult, self).stopTest(test)
 
+def set_nonblocking(fd, nonblocking=True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if nonblocking:
+        flags |= os.O_NONBLOCK
+    else:
+        flags &= ~os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
 class OutputBuffer(object):
     def __init__(self):
-        self.poll = select.poll()
+        self.epoll = select.epoll()
         self.buffers = { }
         self.fds = { }
-
-    def drain(self):
-        while self.fds:
-            for p in self.poll.poll(1000):
-                data = os.read(p[0], 1024)
-                if data == "":
-                    self.poll.unregister(p[0])
-                else:
-                    self.buffers[p[0]] += data
-            else:
-                break
+        self.closed = set()
+
+        # SIGCHLD writes to the wakeup pipe, so that drain() returns as soon as a test exits
+        (self.wakeup, wakeup_w) = os.pipe()
+        set_nonblocking(self.wakeup)
+        set_nonblocking(wakeup_w)
+        self.epoll.register(self.wakeup, select.EPOLLIN | select.EPOLLET)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(wakeup_w)
+
+    def close(self):
+        """Undo the SIGCHLD setup; also needed in forked children"""
+        os.close(signal.set_wakeup_fd(-1))
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(self.wakeup)
+        self.epoll.close()
+
+    def drain(self, timeout=1):
+        """Read whatever output is available, waiting at most TIMEOUT seconds for some to arrive
+
+        Also returns as soon as a child exits.
+        """
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError) as ex:
+            # interrupted by SIGCHLD
+            if ex.errno == errno.EINTR:
+                return
+            raise
+        for (fd, unused) in events:
+            # edge triggered, so read until there is nothing left
+            while True:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as ex:
+                    if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if fd == self.wakeup:
+                    continue
+                if not data:
+                    self.epoll.unregister(fd)
+                    self.closed.add(fd)
+                    break
+                self.buffers[fd].extend(data)
 
     def push(self, pid, fd):
-        self.poll.register(fd, select.POLLIN)
+        set_nonblocking(fd)
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLET)
         self.fds[pid] = fd
-        self.buffers[fd] = ""
+        self.buffers[fd] = bytearray()
 
     def pop(self, pid):
         fd = self.fds.pop(pid)
         buffer = self.buffers.pop(fd)
-        try:
-            self.poll.unregister(fd)
-        except KeyError:
-            pass
+        if fd in self.closed:
+            self.closed.remove(fd)
+        else:
+            self.epoll.unregister(fd)
+        # wait for everything that still has the pipe open to finish writing
+        set_nonblocking(fd, False)
         while True:
-            data = os.read(fd, 1024)
-            if data == "":
+            data = os.read(fd, 65536)
+            if not data:
                 break
-            buffer += data
+            buffer.extend(data)
         os.close(fd)
-        return buffer
+        return bytes(buffer)
 
 class TapRunner(object):
     resultclass = TestResult
@@ -961,24 +1373,25 @@ class TapRunner(object):
 
         def join_some(n):
             while len(pids) > n:
-                if buffer:
-                    buffer.drain()
                 try:
                     (pid, code) = os.waitpid(-1, options)
                 except KeyboardInterrupt:
                     sys.exit(255)
+                if not pid:
+                    # nothing exited yet, collect output until something does
+                    buffer.drain()
+                    continue
                 if code & 0xff:
                     failed = 1
                 else:
                     failed = (code >> 8) & 0xff
-                if pid:
-                    if buffer:
-                        output = buffer.pop(pid)
-                        test = pids[pid]
-                        failed, retry = self.filterOutput(test, failed, output)
-                        if retry:
-                            tests.append(test)
-                    del pids[pid]
+                if buffer:
+                    output = buffer.pop(pid)
+                    test = pids[pid]
+                    failed, retry = self.filterOutput(test, failed, output)
+                    if retry:
+                        tests.append(test)
+                del pids[pid]
                 failures["count"] += failed
 
         while True:
@@ -1003,14 +1416,16 @@ class TapRunner(object):
             pid = os.fork()
             if not pid:
                 if buffer:
+                    buffer.close()
                     os.dup2(wfd, 1)
                     os.dup2(wfd, 2)
                 random.seed()
                 offset = getattr(test, "tapOffset", 0)
-                if self.runOne(test, offset):
-                    sys.exit(0)
-                else:
-                    sys.exit(1)
+                code = 0 if self.runOne(test, offset) else 1
+                # skip the interpreter teardown, nothing in the child needs it
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
 
             # The parent process
             pids[pid] = test
@@ -1018,6 +1433,9 @@ class TapRunner(object):
                 os.close(wfd)
                 buffer.push(pid, rfd)
 
+        if buffer:
+            buffer.close()
+
         # Report on the results
         duration = int(time.time() - start)
         hostname = socket.gethostname().split(".")[0]
@@ -1159,27 +1577,29 @@ def wait(func, msg=None, delay=1, tries=60):
       func: The function to call.
       msg: A error message to use when the timeout occurs.  Defaults
         to a generic message.
-      delay: How long to wait between calls to FUNC, in seconds.
-        Defaults to 1.
-      tries: How often to call FUNC.  Defaults to 60.
+      delay: The longest time to wait between calls to FUNC, in seconds.
+        FUNC is called more often at first.  Defaults to 1.
+      tries: The timeout is DELAY * TRIES seconds.  Defaults to 60.
 
     Raises:
       Error: When a timeout occurs.
     """
 
-    t = 0
-    while t < tries:
+    deadline = time.time() + delay * tries
+    backoff = min(0.01, delay)
+    while True:
+        last = time.time() >= deadline
         try:
             val = func()
             if val:
                 return val
         except:
-            if t == tries-1:
+            if last:
                 raise
-            else:
-                pass
-        t = t + 1
-        sleep(delay)
+        if last:
+            break
+        sleep(max(min(backoff, deadline - time.time()), 0))
+        backoff = min(backoff * 2, delay)
     raise Error(msg or "Condition did not become true.")
 
 def sit(machines={ }):
@@ -30,6 +30,7 @@ import socket
 import subprocess
 import tempfile
 import sys
+import threading
 import time
 
 DEFAULT_IMAGE = os.environ.get("TEST_OS", "fedora-27")
@@ -41,6 +42,9 @@ ATOMIC_IMAGES = ["rhel-atomic", "fedora-atomic", "continuous-atomic"]
 
 LOCAL_DIR = os.path.dirname(__file__)
 
+# the redirection changes process wide file descriptors, so threads must take turns
+stdchannel_lock = threading.RLock()
+
 # based on http://stackoverflow.com/a/17753573
 # we use this to quieten down calls
 @contextlib.contextmanager
@@ -51,17 +55,18 @@ def stdchannel_redirected(stdchannel, dest_filename):
     with stdchannel_redirected(sys.stderr, os.devnull):
         noisy_function()
     """
-    try:
-        stdchannel.flush()
-        oldstdchannel = os.dup(stdchannel.fileno())
-        dest_file = open(dest_filename, 'w')
-        os.dup2(dest_file.fileno(), stdchannel.fileno())
-        yield
-    finally:
-        if oldstdchannel is not None:
-            os.dup2(oldstdchannel, stdchannel.fileno())
-        if dest_file is not None:
-            dest_file.close()
+    with stdchannel_lock:
+        try:
+            stdchannel.flush()
+            oldstdchannel = os.dup(stdchannel.fileno())
+            dest_file = open(dest_filename, 'w')
+            os.dup2(dest_file.fileno(), stdchannel.fileno())
+            yield
+        finally:
+            if oldstdchannel is not None:
+                os.dup2(oldstdchannel, stdchannel.fileno())
+            if dest_file is not None:
+                dest_file.close()
 
 class Timeout:
     """ Add a timeout to an operation
@@ -373,6 +378,40 @@ class Machine:
         if not self._check_ssh_master():
             self._start_ssh_master()
 
+    def _ssh_command(self, direct, options=[]):
+        """Return the ssh command line for running something on the machine, without the command itself"""
+        # default to no translations; can be overridden in environment
+        cmd = [
+            "env", "-u", "LANGUAGE", "LC_ALL=C",
+            "ssh",
+            "-p", str(self.ssh_port),
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "LogLevel=ERROR",
+            "-o", "BatchMode=yes"
+        ] + options
+
+        if direct:
+            cmd += [ "-i", self._calc_identity() ]
+        else:
+            cmd += [ "-o", "ControlPath=" + self.ssh_master ]
+
+        cmd += [
+            "-l", self.ssh_user,
+            self.ssh_address
+        ]
+        return cmd
+
+    def start_ssh_probe(self, **kwargs):
+        """Start checking whether ssh logins work, without waiting for the result
+
+        Returns the subprocess.Popen of an ssh process that exits with 0 if
+        it could log in; KWARGS are passed on to Popen.
+        """
+        assert self.ssh_address
+        cmd = self._ssh_command(True, [ "-o", "ConnectTimeout=5" ]) + [ "true" ]
+        return subprocess.Popen(cmd, **kwargs)
+
     def execute(self, command=None, script=None, input=None, environment={},
                 stdout=None, quiet=False, direct=False, timeout=120):
         """Execute a shell command in the test machine and return its output.
@@ -394,26 +433,7 @@ class Machine:
         if not direct:
             self._ensure_ssh_master()
 
-        # default to no translations; can be overridden in environment
-        cmd = [
-            "env", "-u", "LANGUAGE", "LC_ALL=C",
-            "ssh",
-            "-p", str(self.ssh_port),
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-o", "LogLevel=ERROR",
-            "-o", "BatchMode=yes"
-        ]
-
-        if direct:
-            cmd += [ "-i", self._calc_identity() ]
-        else:
-            cmd += [ "-o", "ControlPath=" + self.ssh_master ]
-
-        cmd += [
-            "-l", self.ssh_user,
-            self.ssh_address
-        ]
+        cmd = self._ssh_command(direct)
 
         if command:
             assert not environment, "Not yet supported"
@@ -438,7 +458,8 @@ class Machine:
             command = "<script>"
 
         if stdout:
-            subprocess.call(cmd, stdout=stdout)
+            # don't let ssh hold on to other pipes, e. g. of executes in other threads
+            subprocess.call(cmd, stdout=stdout, close_fds=True)
             return
 
         with Timeout(seconds=timeout, error_message="Timed out on '%s'" % command, machine=self):